@@ -1,11 +1,48 @@
+import asyncio
+import errno
+import heapq
+import math
+import multiprocessing
+import os
+import queue
+import selectors
+import shutil
+import signal
+import socket
 import subprocess
-from datetime import datetime,timedelta
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
 from os import path
+try:
+    import asyncssh
+except ImportError:
+    asyncssh=None
+try:
+    import paramiko
+except ImportError:
+    paramiko=None
 """
 Class to run shell commands via SSH against multiple systems in parallel
 
 Depends on OpenSSH
 
+SSH connections are multiplexed with OpenSSH ControlMaster: the first command
+run against a host opens a master connection that is kept alive for 60 seconds
+after its last use, and later commands against that host open a channel on it
+instead of reconnecting. max_procs still limits how many channels are opened at once.
+
+AsyncParallelSSH offers the same interface without spawning ssh processes:
+every connection runs on a single asyncio event loop via asyncssh, which
+must be installed separately.
+
+ParallelSSHPool keeps max_procs worker processes alive between run_cmd calls,
+each holding open paramiko connections to the hosts it has served, so repeated
+commands against the same fleet skip connection setup and authentication.
+Each host is always served by the same worker, so it holds one connection.
+It needs paramiko and should be closed with close() when no longer needed.
 
 Example usage:
 
@@ -17,8 +54,121 @@ p_ssh.set_timeout(15)
 p_ssh.run_cmd("ps aux")
 ps_successes=p_ssh.get_successes()
 ps_failures=p_ssh.get_failures()
+p_ssh.run_cmds(["uname -r", "df -h /"])
+kernel_and_disk=p_ssh.get_successes()
+for result in p_ssh.run_cmd_iter("uptime"):
+    print(result)
+p_ssh.close()
 """
-class ParallelSSH:
+
+def _decode_output(output):
+    """decode output stored as bytes, or a list of them from ParallelSSH.run_cmds"""
+    if isinstance(output,list):
+        return [ _decode_output(x) for x in output ]
+    return output.decode("UTF-8",errors="replace")
+
+def _decode_success(result):
+    """decode the output of a (<hostname>,<stdout>,<stderr>,<exit code>) result stored as bytes"""
+    hostname,stdout,stderr,returncode=result
+    return (hostname,_decode_output(stdout),_decode_output(stderr),returncode)
+
+def _split_batch_output(stdout,stderr,marker):
+    r"""Split the output of a ParallelSSH.run_cmds script into per-command lists.
+    After each command the script prints "<marker> <exit code>" on stdout and "<marker>" on stderr.
+    Returns ([<stdout>...],[<stderr>...],[<exit code>...]) for the commands that finished.
+    stdout and stderr hold one more entry than the exit codes: the output after the last
+    marker, which is empty unless a command cut the batch short.
+
+    >>> _split_batch_output(b"one\nM 0\ntwoM 3\n", b"M\nerr\nM\n", b"M")
+    ([b'one\n', b'two', b''], [b'', b'err\n', b''], [0, 3])
+    >>> _split_batch_output(b"one\nM 0\npartial", b"M\nbad\n", b"M")
+    ([b'one\n', b'partial'], [b'', b'bad\n'], [0])
+    >>> _split_batch_output(b"", b"", b"M")
+    ([b''], [b''], [])
+    """
+    out_parts=stdout.split(marker)
+    outs=[out_parts[0]]
+    returncodes=[]
+    for part in out_parts[1:]:
+        status,_,rest=part.partition(b"\n")
+        returncodes.append(int(status))
+        outs.append(rest)
+    err_parts=stderr.split(marker)
+    #drop the newline that ended each marker line
+    errs=[err_parts[0]]+[ part[1:] for part in err_parts[1:] ]
+    #stderr is a marker behind if the shell died between the two printfs
+    errs=errs[:len(outs)]+[b""]*(len(outs)-len(errs))
+    return (outs,errs,returncodes)
+
+
+class _ParallelSSHResults:
+    """Settings, result storage and accessors shared by ParallelSSH, AsyncParallelSSH and ParallelSSHPool"""
+
+    def __init__(self,max_procs,timeout,hostlist):
+        self.max_procs=max_procs
+        self.timeout=timeout
+        self.hostlist=hostlist
+        self.cmd_successes=None
+        self.cmd_failures=None
+        #the cmd_successes list that get_successes() last decoded, and how many of its results are decoded
+        self._decoded_source=None
+        self._decoded_count=0
+
+    def get_successes(self,decode=True):
+        """ return results for hosts where command ran succesfully.
+        Structure is list of tuples as:
+            (<hostname>,<stdout output from host>,<stderr output from host>,<exit code>)
+        After run_cmds, stdout, stderr and exit code are lists with one entry per command.
+        Args:
+            +decode (bool): Optional. Decode stdout and stderr as UTF-8, replacing invalid bytes.
+                If False, they are returned as the raw bytes received. Default is True.
+                Results are decoded in place, once, so the raw bytes are not kept: after a
+                decoding call, decode=False returns the decoded output too until the next run.
+        """
+        if not decode or self.cmd_successes==None:
+            return self.cmd_successes
+        if not self._decoded_source is self.cmd_successes:
+            self._decoded_source=self.cmd_successes
+            self._decoded_count=0
+        #only decode results stored since the last call
+        for index in range(self._decoded_count,len(self.cmd_successes)):
+            self.cmd_successes[index]=_decode_success(self.cmd_successes[index])
+        self._decoded_count=len(self.cmd_successes)
+        return self.cmd_successes
+
+    def get_failures(self):
+        """ return results for hosts where command failed.
+        Structure is list of tuples:
+            (<hostname>,<error message>,<exit code (None if unavaialable)>)
+        """
+        return self.cmd_failures
+
+    def set_hostlist(self,hostlist):
+        self.hostlist=hostlist
+
+    def set_max_procs(self, max_procs):
+        self.max_procs=max_procs
+
+    def set_timeout(self,timeout):
+        self.timeout=timeout
+
+
+class ParallelSSH(_ParallelSSHResults):
+
+    #seconds between polls of running processes when pidfds are unavailable
+    _poll_interval=0.05
+    #pidfds let the selector wake as soon as a child exits. Cleared for good once the kernel or a
+    #seccomp filter refuses them, after which children are polled instead.
+    _use_pidfd=hasattr(os,"pidfd_open") and hasattr(os,"P_PIDFD")
+    #bytes requested per read of an ssh output pipe; the default Linux pipe capacity, so one read empties a full pipe
+    _read_size=65536
+    #close inherited fds in the ssh children where posix_spawn can still do it (CPython 3.13+). Older versions only
+    #use posix_spawn with close_fds=False, so there we trade the closing for a fork cost that does not grow with
+    #our RSS; fds the embedding process inherited or marked inheritable then leak into ssh and its ControlPersist master
+    _close_fds=getattr(subprocess,"_HAVE_POSIX_SPAWN_CLOSEFROM",False)
+    #(ssh_bin, mtime) pairs that already passed __check_ssh, shared by all instances
+    _checked_bins=set()
+    _checked_bins_lock=threading.Lock()
 
     def __init__(self,max_procs=1,timeout=None,hostlist=None,ssh_bin="/usr/bin/ssh"):
         """constructor
@@ -32,51 +182,77 @@ class ParallelSSH:
         """
         self.ssh_bin=ssh_bin
         self.__check_ssh()
-        self.max_procs=max_procs
-        self.timeout=timeout
-        self.hostlist=hostlist
-        self.cmd_successes=None
-        self.cmd_failures=None
+        super().__init__(max_procs,timeout,hostlist)
+        #directory holding ControlMaster sockets
+        self._cm_dir=tempfile.mkdtemp(prefix="pssh-cm-")
+        #exponentially weighted moving average of each host's run time in seconds, across run_cmd calls
+        self._host_ewma={}
+
+    def __del__(self):
+        if getattr(self,"_cm_dir",None):
+            self.close()
 
 
     def __append_failure(self,hostname,error,returncode):
         self.cmd_failures.append((hostname,error,returncode))
 
     def __append_success(self, hostname, stdout,stderr,returncode):
-        self.cmd_successes.append((hostname,stdout.decode("UTF-8"),stderr.decode("UTF-8"),returncode))
+        #output is kept as bytes and only decoded if get_successes is asked to
+        self.cmd_successes.append((hostname,stdout,stderr,returncode))
 
 
     def __check_ssh(self):
-        """Check that available SSH implementation is compatible. Raise error if not"""
+        """Check that available SSH implementation is compatible. Raise error if not.
+        A binary that passed is not checked again until its mtime changes.
+        """
         if not path.isfile(self.ssh_bin):
             raise RuntimeError(f"Expected SSH path is missing: {self.ssh_bin}")
-        version_cmd=[self.ssh_bin, "-V"]
-        version_cmd_fmt=" ".join(version_cmd)
-        #openssh prints version to stderr
-        proc=subprocess.run(version_cmd, stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
-        if not proc.returncode == 0:
-            raise RuntimeError(f"{version_cmd_fmt} returned non-zero exit code")
-        ssh_ver=proc.stdout.decode("UTF-8")
-        #print(ssh_ver)
-        if len(ssh_ver) < 1:
-            raise RuntimeError(f"No output from {version_cmd_fmt}")
-        if not "openssh" in ssh_ver.lower():
-            raise RuntimeError(f"Expecting OpenSSH implementation:\n {version_cmd_fmt} reported {ssh_ver}.")
-
-
-    def get_successes(self):
-        """ return results for hosts where command ran succesfully.
-        Structure is list of tuples as:
-            (<hostname>,<stdout output from host>,<stderr output from host>,<exit code>)
-        """
-        return self.cmd_successes
+        checked_key=(self.ssh_bin, os.stat(self.ssh_bin).st_mtime)
+        with ParallelSSH._checked_bins_lock:
+            if checked_key in ParallelSSH._checked_bins:
+                return
+            version_cmd=[self.ssh_bin, "-V"]
+            version_cmd_fmt=" ".join(version_cmd)
+            #openssh prints version to stderr
+            proc=subprocess.run(version_cmd, stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+            if not proc.returncode == 0:
+                raise RuntimeError(f"{version_cmd_fmt} returned non-zero exit code")
+            ssh_ver=proc.stdout.decode("UTF-8")
+            #print(ssh_ver)
+            if len(ssh_ver) < 1:
+                raise RuntimeError(f"No output from {version_cmd_fmt}")
+            if not "openssh" in ssh_ver.lower():
+                raise RuntimeError(f"Expecting OpenSSH implementation:\n {version_cmd_fmt} reported {ssh_ver}.")
+            ParallelSSH._checked_bins.add(checked_key)
 
-    def get_failures(self):
-        """ return results for hosts where command failed. See __append_failure for data structure
-        Structure is list of tuples:
-            (<hostname>,<error message>,<exit code (None if unavaialable)>)
+
+    def __control_opts(self):
+        """ssh options to share one master connection per host"""
+        if self._cm_dir==None:
+            self._cm_dir=tempfile.mkdtemp(prefix="pssh-cm-")
+        #%C is a fixed-length hash of the connection, so long user or host names cannot push
+        #the socket path past the unix socket length limit
+        return ["-o", "ControlMaster=auto", "-o", f"ControlPath={self._cm_dir}/%C", "-o", "ControlPersist=60s"]
+
+    def close(self):
+        """Shut down any ControlMaster connections and remove their socket directory.
+        The object can still be used afterwards; new master connections are opened as needed.
         """
-        return self.cmd_failures
+        if self._cm_dir==None:
+            return
+        #each socket left in the directory is a master still running. The socket path is given
+        #literally, so the host argument is only a placeholder and is never contacted.
+        #Up to max_procs exits run at once.
+        exiting=deque()
+        for socket_name in os.listdir(self._cm_dir):
+            exit_cmd=[self.ssh_bin, "-qo", f"ControlPath={path.join(self._cm_dir,socket_name)}", "-O", "exit", "pssh-control"]
+            exiting.append(subprocess.Popen(exit_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+            if len(exiting) >= max(1,self.max_procs):
+                exiting.popleft().wait()
+        for proc in exiting:
+            proc.wait()
+        shutil.rmtree(self._cm_dir, ignore_errors=True)
+        self._cm_dir=None
 
     def run_cmd(self,remote_cmd,expected_exit_code=0):
         """Run a command against the list of hosts
@@ -84,53 +260,582 @@ class ParallelSSH:
             +remote_cmd (str): the command to run
             +expected_exit_code (int): Optional. Specify the return code you expect for the SSH process. Default is 0.
         """
+        self.cmd_successes=[]
+        self.cmd_failures=[]
+        for event in self.__run(remote_cmd,expected_exit_code):
+            if event[0]=="ok":
+                self.__append_success(*event[1:])
+            else:
+                self.__append_failure(*event[1:])
 
+    def run_cmd_iter(self,remote_cmd,expected_exit_code=0,decode=True):
+        """Run a command against the list of hosts, yielding each host's result as soon as it completes.
+        Nothing is stored for get_successes/get_failures, so memory use does not grow with the hostlist.
+        Yields tuples as:
+            ("ok",<hostname>,<stdout output from host>,<stderr output from host>,<exit code>)
+            ("fail",<hostname>,<error message>,<exit code (None if unavaialable)>)
+        Args:
+            +remote_cmd (str): the command to run
+            +expected_exit_code (int): Optional. Specify the return code you expect for the SSH process. Default is 0.
+            +decode (bool): Optional. Decode stdout and stderr as in get_successes. Default is True.
+        """
+        for event in self.__run(remote_cmd,expected_exit_code):
+            if decode and event[0]=="ok":
+                event=("ok",)+_decode_success(event[1:])
+            yield event
+
+    def run_cmds(self,remote_cmds,expected_exit_code=0):
+        """Run several commands one after another on each host over a single SSH session.
+        The commands are fed as a script to bash on the remote side, so they share its
+        working directory and environment but do not see its stdin.
+        A host is a success when every command returns expected_exit_code. Otherwise the exit code
+        of its failure is always the list of exit codes of the commands that ran:
+            "Unexpected Return Code": every command ran and at least one returned something else
+            "Command Batch Interrupted": a command exited the shell, or the script stopped on a
+                syntax error; the last entry is the shell's exit status
+        Connection failures (ssh exit code 255 before any command finished) and timeouts
+        report None, as "Connection Failed" and "Timeout Exceeded".
+        Args:
+            +remote_cmds (list): the commands to run, in order
+            +expected_exit_code (int): Optional. Specify the exit code you expect from every command. Default is 0.
+        """
+        #after each command, print a marker with its exit code to stdout and a marker to stderr
+        marker=f"__PSSH_SEP_{uuid.uuid4().hex}__"
+        script="".join(
+            f"{{\n{cmd}\n}} </dev/null\n"
+            f"__pssh_rc=$?\n"
+            f"printf '%s %d\\n' {marker} $__pssh_rc\n"
+            f"printf '%s\\n' {marker} >&2\n"
+            for cmd in remote_cmds)
+        marker=marker.encode("UTF-8")
         self.cmd_successes=[]
         self.cmd_failures=[]
-        running_procs=[]
+        #every exit status of bash is accepted here, the markers tell how the commands did
+        for event in self.__run("bash -s",None,script.encode("UTF-8")):
+            if not event[0]=="ok":
+                self.__append_failure(*event[1:])
+                continue
+            _,hostname,stdout,stderr,shell_returncode=event
+            outs,errs,returncodes=_split_batch_output(stdout,stderr,marker)
+            if shell_returncode==255 and not returncodes:
+                #ssh itself failed
+                self.__append_failure(hostname,"Connection Failed",None)
+            elif len(returncodes) < len(remote_cmds):
+                #the shell's exit status stands in for the command it stopped at
+                returncodes.append(shell_returncode)
+                self.__append_failure(hostname,"Command Batch Interrupted",returncodes)
+            elif all(returncode==expected_exit_code for returncode in returncodes):
+                self.__append_success(hostname,outs[:-1],errs[:-1],returncodes)
+            else:
+                self.__append_failure(hostname,"Unexpected Return Code",returncodes)
+
+    def __run(self,remote_cmd,expected_exit_code,script=None):
+        """Generator running remote_cmd against the list of hosts. Yields ("ok",<hostname>,<stdout>,<stderr>,<exit code>)
+        or ("fail",<hostname>,<error message>,<exit code>) as each host completes, with output as bytes.
+        If script (bytes) is given, it is written to the stdin of each SSH process.
+        If expected_exit_code is None, every exit code counts as "ok".
+        """
+        #running processes keyed by pid: (process, start time, deadline, pidfd, stdout buffer, stderr buffer)
+        #times are time.monotonic() values, deadline is None when there is no timeout, pidfd is None when polled
+        running={}
+        #pids of running processes that have no pidfd and must be polled
+        polled=set()
+        #pid of each pidfd, so an exit wakes only the process it belongs to
+        pidfd_pids={}
+        #heap of (deadline, pid). Entries of processes that finished first are left behind
+        #and skipped when they come up.
+        deadlines=[]
+        #settings are read once so set_timeout()/set_max_procs() between yields of a lazily consumed
+        #run cannot mix deadlines computed under different timeouts
+        timeout=self.timeout
+        max_procs=self.max_procs
 
         #base SSH command
-        ssh_cmd=[self.ssh_bin, "-nqo", "BatchMode=yes"]
-        cmds_to_run=[ ssh_cmd + [host,remote_cmd] for host in self.hostlist ]
+        ssh_cmd=[self.ssh_bin, "-qo", "BatchMode=yes"] + self.__control_opts()
+        #hosts that took longest last time start first so they don't finish last (longest processing
+        #time first); hosts never seen before lead since nothing is known about them.
+        #Their ssh command is built when a slot frees up.
+        hosts_to_run=deque(sorted(self.hostlist, key=lambda host: -self._host_ewma.get(host,math.inf)))
 
-        #hostname expected to be 4th argument in ssh command
+        #hostname expected to be second to last argument in ssh command
         def get_hostname(process):
-            return(process.args[3])
+            return(process.args[-2])
 
-        while True:
-            #initialize SSH processes until max_procs is reached
-            while len(running_procs) < self.max_procs and len(cmds_to_run) > 0: 
-                running_procs.append([subprocess.Popen(cmds_to_run.pop(), stdout=subprocess.PIPE, stderr=subprocess.PIPE), datetime.now()])
+        def drain(pipe,buf,once=False):
+            """read everything currently available from a non-blocking pipe into buf. Returns True at EOF.
+            With once, stop after a single read: the selector is level-triggered and reports the pipe
+            again if more is waiting, so the read that would only hit EAGAIN is skipped.
+            """
+            while True:
+                try:
+                    chunk=os.read(pipe.fileno(),self._read_size)
+                except BlockingIOError:
+                    return False
+                if not chunk:
+                    return True
+                buf.extend(chunk)
+                if once:
+                    return False
+
+        def feed(pipe,pending):
+            """write as much of the remaining script as the pipe accepts, closing it once all is sent"""
+            try:
+                written=os.write(pipe.fileno(),pending[0])
+            except BlockingIOError:
+                written=0
+            except BrokenPipeError:
+                #the remote side stopped reading; its exit status tells the rest
+                written=len(pending[0])
+            pending[0]=pending[0][written:]
+            if not pending[0]:
+                close_pipe(pipe)
+
+        def close_pipe(pipe):
+            if not pipe.closed:
+                if pipe in sel.get_map():
+                    sel.unregister(pipe)
+                pipe.close()
+
+        def open_pidfd(proc):
+            """pidfd for proc, or None if it can't be used and proc has to be polled"""
+            try:
+                fd=os.pidfd_open(proc.pid)
+            except OSError as e:
+                #ENOSYS before Linux 5.3, EPERM under seccomp profiles that predate pidfds
+                if e.errno in (errno.ENOSYS,errno.EPERM):
+                    ParallelSSH._use_pidfd=False
+                return None
+            #waiting on a pidfd needs Linux 5.4, one release after pidfd_open. WNOWAIT leaves
+            #the exit status of a child that is already done for reap()
+            try:
+                os.waitid(os.P_PIDFD,fd,os.WEXITED|os.WNOHANG|os.WNOWAIT)
+            except OSError as e:
+                os.close(fd)
+                if e.errno in (errno.EINVAL,errno.ENOSYS,errno.EPERM):
+                    ParallelSSH._use_pidfd=False
+                return None
+            return fd
+
+        sel=selectors.DefaultSelector()
+
+        def fill_slots():
+            """initialize SSH processes until max_procs is reached"""
+            while len(running) < max_procs and hosts_to_run:
+                #keep Popen eligible for CPython's posix_spawn fast path: no cwd/env/preexec_fn (see _close_fds)
+                proc=subprocess.Popen([*ssh_cmd, hosts_to_run.popleft(), remote_cmd], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                      stdin=subprocess.DEVNULL if script==None else subprocess.PIPE, close_fds=self._close_fds)
+                fd=None
+                try:
+                    if self._use_pidfd:
+                        fd=open_pidfd(proc)
+                    if fd==None:
+                        polled.add(proc.pid)
+                    else:
+                        sel.register(fd,selectors.EVENT_READ)
+                        pidfd_pids[fd]=proc.pid
+                    #output is drained as it arrives so a chatty host cannot fill the pipe and stall
+                    out_buf=bytearray()
+                    err_buf=bytearray()
+                    for pipe,buf in ((proc.stdout,out_buf),(proc.stderr,err_buf)):
+                        os.set_blocking(pipe.fileno(),False)
+                        sel.register(pipe,selectors.EVENT_READ,data=buf)
+                    if not script==None:
+                        os.set_blocking(proc.stdin.fileno(),False)
+                        sel.register(proc.stdin,selectors.EVENT_WRITE,data=[memoryview(script)])
+                except BaseException:
+                    #proc is not in running yet, so the cleanup at the end of __run would miss it
+                    polled.discard(proc.pid)
+                    pidfd_pids.pop(fd,None)
+                    proc.kill()
+                    proc.wait()
+                    for pipe in (proc.stdin,proc.stdout,proc.stderr):
+                        if not pipe==None:
+                            close_pipe(pipe)
+                    if not fd==None:
+                        if fd in sel.get_map():
+                            sel.unregister(fd)
+                        os.close(fd)
+                    raise
+                started=time.monotonic()
+                deadline=None if timeout==None else started+timeout
+                running[proc.pid]=(proc, started, deadline, fd, out_buf, err_buf)
+                if not deadline==None:
+                    heapq.heappush(deadlines,(deadline,proc.pid))
+
+        def kill(proc,fd):
+            """SIGKILL a process. Through the pidfd when there is one, since Popen.kill() polls first
+            and can reap the child behind the pidfd's back"""
+            if fd==None:
+                proc.kill()
+                return
+            try:
+                signal.pidfd_send_signal(fd,signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        def reap(proc,fd):
+            """collect the exit status of a finished or killed process"""
+            if not proc.returncode==None:
+                return
+            if fd==None:
+                proc.wait()
+                return
+            #wait on the pidfd directly; returncode is set by hand so Popen does not reap again
+            info=os.waitid(os.P_PIDFD,fd,os.WEXITED)
+            if info.si_code==os.CLD_EXITED:
+                proc.returncode=info.si_status
+            else:
+                proc.returncode=-info.si_status
+
+        def release_slot(pid,fd):
+            """forget a reaped process, note how long it ran and start the next queued host in its place"""
+            proc,started,*_=running.pop(pid)
+            polled.discard(pid)
+            host=get_hostname(proc)
+            elapsed=time.monotonic()-started
+            previous=self._host_ewma.get(host)
+            self._host_ewma[host]=elapsed if previous==None else 0.7*previous+0.3*elapsed
+            if not fd==None:
+                del pidfd_pids[fd]
+                sel.unregister(fd)
+                os.close(fd)
+            fill_slots()
+
+        def is_current(entry):
+            """whether a deadline heap entry still belongs to a running process"""
+            deadline,pid=entry
+            return pid in running and running[pid][2]==deadline
+
+        try:
+            fill_slots()
+            while running:
+                #block until output arrives, a process exits or the nearest timeout expires
+                while deadlines and not is_current(deadlines[0]):
+                    heapq.heappop(deadlines)
+                wait_time=self._poll_interval if polled else None
+                if deadlines:
+                    remaining=max(0,deadlines[0][0]-time.monotonic())
+                    wait_time=remaining if wait_time==None else min(wait_time,remaining)
+                finished=[]
+                for key,events in sel.select(timeout=wait_time):
+                    if key.data==None:
+                        finished.append(pidfd_pids[key.fd])
+                    elif events & selectors.EVENT_WRITE:
+                        feed(key.fileobj,key.data)
+                    elif drain(key.fileobj,key.data,once=True):
+                        close_pipe(key.fileobj)
+                #processes without a pidfd have to be asked
+                finished.extend(pid for pid in polled if not running[pid][0].poll()==None)
+
+                for pid in finished:
+                    proc,_,_,fd,out_buf,err_buf=running[pid]
+                    reap(proc,fd)
+                    #start the next host before collecting this one's output
+                    release_slot(pid,fd)
+                    #pick up whatever the process wrote after the last wakeup
+                    for pipe,buf in ((proc.stdout,out_buf),(proc.stderr,err_buf)):
+                        if not pipe.closed:
+                            drain(pipe,buf)
+                            close_pipe(pipe)
+                    if not proc.stdin==None:
+                        close_pipe(proc.stdin)
+                    if expected_exit_code==None or proc.returncode==expected_exit_code:
+                        yield ("ok",get_hostname(proc),bytes(out_buf),bytes(err_buf),proc.returncode)
+                    else:
+                        yield ("fail",get_hostname(proc),"Unexpected Return Code", proc.returncode)
+
+                #kill processes whose deadline has passed; nothing to do before the nearest one
+                now=time.monotonic()
+                while deadlines and deadlines[0][0] <= now:
+                    entry=heapq.heappop(deadlines)
+                    if not is_current(entry):
+                        continue
+                    pid=entry[1]
+                    proc,_,_,fd,_,_=running[pid]
+                    kill(proc,fd)
+                    reap(proc,fd)
+                    close_pipe(proc.stdout)
+                    close_pipe(proc.stderr)
+                    if not proc.stdin==None:
+                        close_pipe(proc.stdin)
+                    release_slot(pid,fd)
+                    yield ("fail",get_hostname(proc),"Timeout Exceeded",None)
+        finally:
+            #the caller stopped early or something failed: don't leave ssh processes behind
+            for proc,_,_,fd,_,_ in running.values():
+                kill(proc,fd)
+                reap(proc,fd)
+                for pipe in (proc.stdin,proc.stdout,proc.stderr):
+                    if not pipe==None:
+                        close_pipe(pipe)
+                if not fd==None:
+                    os.close(fd)
+            sel.close()
+
+
+
+class AsyncParallelSSH(_ParallelSSHResults):
+
+    def __init__(self,max_procs=1,timeout=None,hostlist=None):
+        """constructor
+        Args:
+            + max_procs (int): maximum number of SSH connections to run in parallel
+            + timeout (int): time in seconds to wait before abandoning connections
+                that have not completed. If None, then waits until the command exits.
+            + hostlist (list): list of strings containing hostnames or IP addresses that
+                commands will be run against
+        """
+        if asyncssh==None:
+            raise RuntimeError("AsyncParallelSSH requires the asyncssh package")
+        super().__init__(max_procs,timeout,hostlist)
+
+    async def run_cmd_async(self,remote_cmd,expected_exit_code=0):
+        """Run a command against the list of hosts from within a running event loop
+        Args:
+            +remote_cmd (str): the command to run
+            +expected_exit_code (int): Optional. Specify the exit status you expect from the command. Default is 0.
+        """
+        self.cmd_successes=[]
+        self.cmd_failures=[]
+        #max_procs workers each take the next host as soon as they finish one
+        queue=asyncio.Queue()
+        for host in self.hostlist:
+            queue.put_nowait(host)
+
+        async def run_one(host):
+            async with asyncssh.connect(host) as conn:
+                return await conn.run(remote_cmd,encoding=None)
+
+        async def worker():
+            while not queue.empty():
+                host=queue.get_nowait()
+                try:
+                    result=await asyncio.wait_for(run_one(host),self.timeout)
+                except asyncio.TimeoutError:
+                    self.cmd_failures.append((host,"Timeout Exceeded",None))
+                except Exception as e:
+                    #OSError and asyncssh.Error mostly, but anything else from one host must not
+                    #abort the gather and lose the other hosts' results
+                    self.cmd_failures.append((host,f"Connection Failed: {e}",None))
+                else:
+                    if result.exit_status==expected_exit_code:
+                        self.cmd_successes.append((host,result.stdout,result.stderr,result.exit_status))
+                    else:
+                        self.cmd_failures.append((host,"Unexpected Return Code",result.exit_status))
+
+        await asyncio.gather(*[ worker() for _ in range(min(self.max_procs,len(self.hostlist))) ])
+
+    def run_cmd(self,remote_cmd,expected_exit_code=0):
+        """Run a command against the list of hosts. See run_cmd_async for arguments"""
+        asyncio.run(self.run_cmd_async(remote_cmd,expected_exit_code))
+
+
+#paramiko clients of a ParallelSSHPool worker process, keyed by hostname
+_worker_clients=None
 
-            if len(running_procs)==0 and len(cmds_to_run)==0:
+def _worker_main(jobs,results):
+    """ParallelSSHPool worker process: run jobs from its own queue until it receives None"""
+    global _worker_clients
+    _worker_clients={}
+    try:
+        for job in iter(jobs.get,None):
+            try:
+                result=_worker_exec(job)
+            except Exception as e:
+                #anything _worker_exec did not expect still ends this job only, not the worker
+                host=job[0]
+                client=_worker_clients.pop(host,None)
+                if not client==None:
+                    client.close()
+                result=(host,None,None,None,f"Connection Failed: {e}")
+            results.put(result)
+    finally:
+        for client in _worker_clients.values():
+            client.close()
+
+def _read_channel(channel,timeout):
+    """Read stdout and stderr of an exec channel together until the command finishes.
+    Both streams share one flow control window, so reading one to EOF before the other
+    stalls a host that writes a lot to the second. Raises socket.timeout after timeout seconds.
+    Returns (<stdout>,<stderr>,<exit code>)
+    """
+    deadline=None if timeout==None else time.monotonic()+timeout
+    def remaining():
+        if deadline==None:
+            return None
+        left=deadline-time.monotonic()
+        if left <= 0:
+            raise socket.timeout()
+        return left
+
+    out=bytearray()
+    err=bytearray()
+    #the channel's fileno becomes ready when either stream has data or reaches EOF
+    with selectors.DefaultSelector() as sel:
+        sel.register(channel,selectors.EVENT_READ)
+        while True:
+            #everything the host sent precedes its EOF or close, so check before reading
+            eof=channel.eof_received or channel.closed
+            while channel.recv_ready():
+                out.extend(channel.recv(65536))
+            while channel.recv_stderr_ready():
+                err.extend(channel.recv_stderr(65536))
+            if eof:
                 break
+            sel.select(remaining())
+    if not channel.status_event.wait(remaining()):
+        raise socket.timeout()
+    return (bytes(out),bytes(err),channel.exit_status)
 
-            #iterate over processes until one or more finishes
-            while not None in running_procs:
-                for i in range(0,len(running_procs)):
-                    proc,start_time = running_procs[i]
-                    if not proc.poll()==None: #process finished
-                        out,err=proc.communicate()
-                        if proc.returncode==expected_exit_code:
-                            self.__append_success(get_hostname(proc),out,err,proc.returncode)
-                        else:
-                            self.__append_failure(get_hostname(proc),"Unexpected Return Code", proc.returncode)
-                        running_procs[i]=None
-                    if not self.timeout==None:
-                        #check if process has exceeded timeout
-                        if datetime.now() >= start_time+timedelta(seconds=self.timeout):
-                            proc.kill()
-                            running_procs[i]=None
-                            self.__append_failure(get_hostname(proc),"Timeout Exceeded",None)
-            #remove finished processes
-            running_procs=[x for x in running_procs if x is not None]
+def _worker_exec(job):
+    """Run a command on one host from a pool worker, reusing the worker's connection when it is still up.
+    Returns (<hostname>,<stdout>,<stderr>,<exit code>,<error message (None if the command ran)>)
+    """
+    host,remote_cmd,timeout=job
+    client=_worker_clients.get(host)
+    try:
+        if client==None or not client.get_transport() or not client.get_transport().is_active():
+            client=paramiko.SSHClient()
+            client.load_system_host_keys()
+            client.connect(host,timeout=timeout,banner_timeout=timeout,auth_timeout=timeout)
+            _worker_clients[host]=client
+        stdin,stdout,_=client.exec_command(remote_cmd,timeout=timeout)
+        stdin.close()
+        out,err,returncode=_read_channel(stdout.channel,timeout)
+        return (host,out,err,returncode,None)
+    except socket.timeout:
+        error="Timeout Exceeded"
+    except (OSError,EOFError,paramiko.SSHException) as e:
+        error=f"Connection Failed: {e}"
+    #drop the connection so the next command against this host starts fresh
+    if not client==None:
+        client.close()
+    _worker_clients.pop(host,None)
+    return (host,None,None,None,error)
 
-    def set_hostlist(self,hostlist):
-        self.hostlist=hostlist
 
-    def set_max_procs(self, max_procs):
-        self.max_procs=max_procs
+class ParallelSSHPool(_ParallelSSHResults):
 
-    def set_timeout(self,timeout):
-        self.timeout=timeout
+    #seconds between checks that the workers are still alive while waiting for results
+    _poll_interval=1
+
+    def __init__(self,max_procs=1,timeout=None,hostlist=None):
+        """constructor
+        Args:
+            + max_procs (int): number of worker processes, and so the number of commands run in parallel
+            + timeout (int): time in seconds allowed for each step of reaching a host (TCP connect,
+                SSH banner, authentication), and then again for the command to finish, before
+                giving up on it. If None, then waits until the command exits.
+            + hostlist (list): list of strings containing hostnames or IP addresses that
+                commands will be run against
+        """
+        if paramiko==None:
+            raise RuntimeError("ParallelSSHPool requires the paramiko package")
+        super().__init__(max_procs,timeout,hostlist)
+        #worker processes with their job queues, started on first use so set_max_procs can resize them
+        self._workers=None
+        self._results=None
+        #each host always goes to the same worker, so only that worker keeps a connection to it
+        self._host_worker={}
+        self._worker_hosts=None
+
+    def __del__(self):
+        if getattr(self,"_workers",None):
+            self.close()
+
+    def close(self):
+        """Stop the worker processes, closing their connections"""
+        if self._workers==None:
+            return
+        for _,jobs in self._workers:
+            jobs.put(None)
+        for worker,jobs in self._workers:
+            worker.join()
+            jobs.close()
+        self._results.close()
+        self._workers=None
+        self._results=None
+        self._host_worker={}
+
+    def __start_workers(self):
+        self._results=multiprocessing.Queue()
+        self._workers=[ self.__start_worker() for _ in range(max(1,self.max_procs)) ]
+        self._worker_hosts=[0]*len(self._workers)
 
+    def __start_worker(self):
+        """start one worker process, returning it with its job queue"""
+        jobs=multiprocessing.Queue()
+        worker=multiprocessing.Process(target=_worker_main,args=(jobs,self._results),daemon=True)
+        worker.start()
+        return (worker,jobs)
+
+    def __replace_worker(self,index):
+        """start a new worker in place of a dead one. Its hosts stay assigned to the slot."""
+        worker,jobs=self._workers[index]
+        worker.join()
+        #jobs left in the old queue are never read, so don't wait to flush them
+        jobs.cancel_join_thread()
+        jobs.close()
+        self._workers[index]=self.__start_worker()
+
+    def __worker_for(self,host):
+        """index of the worker serving host; new hosts go to the worker serving the fewest"""
+        if not host in self._host_worker:
+            index=self._worker_hosts.index(min(self._worker_hosts))
+            self._host_worker[host]=index
+            self._worker_hosts[index]+=1
+        return self._host_worker[host]
+
+    def run_cmd(self,remote_cmd,expected_exit_code=0):
+        """Run a command against the list of hosts
+        Args:
+            +remote_cmd (str): the command to run
+            +expected_exit_code (int): Optional. Specify the exit status you expect from the command. Default is 0.
+        """
+        self.cmd_successes=[]
+        self.cmd_failures=[]
+        if self._workers==None:
+            self.__start_workers()
+
+        #hosts each worker still owes a result for
+        pending=[ [] for _ in self._workers ]
+        for host in self.hostlist:
+            index=self.__worker_for(host)
+            self._workers[index][1].put((host,remote_cmd,self.timeout))
+            pending[index].append(host)
+
+        def collect(result):
+            host,out,err,returncode,error=result
+            pending[self._host_worker[host]].remove(host)
+            if not error==None:
+                self.cmd_failures.append((host,error,None))
+            elif returncode==expected_exit_code:
+                self.cmd_successes.append((host,out,err,returncode))
+            else:
+                self.cmd_failures.append((host,"Unexpected Return Code",returncode))
+
+        while any(pending):
+            try:
+                collect(self._results.get(timeout=self._poll_interval))
+                continue
+            except queue.Empty:
+                pass
+            #a worker that died will never answer for its hosts
+            for index,(worker,_) in enumerate(self._workers):
+                if not pending[index] or worker.is_alive():
+                    continue
+                #whatever it sent before exiting is already in the results queue
+                while True:
+                    try:
+                        collect(self._results.get_nowait())
+                    except queue.Empty:
+                        break
+                for host in pending[index]:
+                    self.cmd_failures.append((host,f"Worker Process Died (exit code {worker.exitcode})",None))
+                pending[index]=[]
+                self.__replace_worker(index)
+
+    def set_max_procs(self, max_procs):
+        if not max_procs==self.max_procs:
+            self.close()
+        self.max_procs=max_procs